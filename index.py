@@ -2,11 +2,15 @@ from flask import *
 from modules.TinyDBController import TinyDBController
 from modules.SeleniumController import SeleniumController
 from modules.NetworkController import NetworkController
-from modules.OrderController import OrderController
+from modules.OrderController import OrderController, export_formats
+from modules.SimulationController import SimulationController
 from werkzeug.utils import secure_filename
 import os
 import numpy as np
 import csv
+import hashlib
+import uuid
+import gzip
 
 referral_bonus_rules = [
     {'product_name': 'default', 'bonus_tiers': [0.05]},  # applies to all products
@@ -35,17 +39,20 @@ TinyDBObj.update('user', 'name', 'c', 'age', 99)
 
 
 # start TinyDB process & load tables
-db_engine = TinyDBController('./tables',['user', 'logs', 'rules', 'order_history'], True, True)
+db_engine = TinyDBController('./tables',['user', 'logs', 'rules', 'order_history', 'payment_results', 'network_runs', 'network_schedule'], True, True)
 
 # start selenium headless browser
 selenium = SeleniumController(True, db_engine)
 
-# run mlm network engine
-mlm_network = NetworkController(db_engine, selenium, 86400, True)
+# run mlm network engine. syncs daily (+/- 1 hour) in a background thread
+mlm_network = NetworkController(db_engine, selenium, 86400, False, 3600)
 
 # run Order Controller
 order_engine = OrderController(db_engine, mlm_network, referral_bonus_rules)
 
+# run commission simulator (read only, never touches the ledger)
+simulation_engine = SimulationController(db_engine, mlm_network)
+
 
 def create_error_response(message, code):
     payload = {"error_message": message, "http_code": code}
@@ -91,29 +98,59 @@ def handle_csv_upload(request):
         return
     file = request.files['file']
 
-    # save csv locally
-    file.save(os.path.join('./uploads', secure_filename(file.filename)))
+    # uploads are identified by content hash, so re-uploading the same export hits the cached result.
+    # results are stored under this id so any worker can serve them
+    upload_id = hashlib.sha256(file.read()).hexdigest()
+    file.seek(0)
+
+    # save csv locally once per content. written to a temporary name first so
+    # another worker never reads a half-saved file
+    filepath = os.path.join('./uploads', '{}_{}'.format(upload_id, secure_filename(file.filename)))
+    if not os.path.exists(filepath):
+        temp_path = '{}.{}.part'.format(filepath, uuid.uuid4().hex)
+        file.save(temp_path)
+        os.replace(temp_path, filepath)
 
     # reads csv file with csv reader
-    order_engine.read_csv('./uploads/' + file.filename)
+    return order_engine.read_csv(filepath, upload_id)
 
 
 @app.route('/upload-csv', methods=['POST'])
 def csv_upload_endpoint():
-    handle_csv_upload(request)
-    payload = {"results": 'lol'}
+    upload_id = handle_csv_upload(request)
+    payload = {"results": 'lol', "upload_id": upload_id}
     response = jsonify(payload)
     response.headers.add('Access-Control-Allow-Origin', '*')
     return response, 200
 
 
+# queues a network sync in the background. see /network-status for its progress
 @app.route('/rebuild-network', methods=['POST'])
 def rebuild_network():
-    selenium.start_browser()
-    selenium.secomapp_login()
-    mlm_network.build_network()
-    selenium.close_browser()
-    payload = {"status": 'success'}
+    payload = {"status": 'queued', "schedule": mlm_network.trigger_process()}
+    response = jsonify(payload)
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response, 202
+
+
+@app.route('/network-status', methods=['GET'])
+def network_status():
+    payload = {"schedule": mlm_network.get_schedule_state()}
+    response = jsonify(payload)
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response, 200
+
+
+# evaluates candidate rule sets against the order history without paying anything out.
+# body: {"rule_sets": [referral_bonus_rules, ...]}
+@app.route('/simulate-commissions', methods=['POST'])
+def simulate_commissions():
+    body = request.get_json(silent=True) or {}
+    try:
+        simulation_engine.validate_rule_sets(body.get('rule_sets'))
+    except ValueError as e:
+        return create_error_response(str(e), 400)
+    payload = simulation_engine.simulate(body['rule_sets'])
     response = jsonify(payload)
     response.headers.add('Access-Control-Allow-Origin', '*')
     return response, 200
@@ -130,12 +167,68 @@ def logs_endpoint():
 
 @app.route("/get-latest-csv")
 def get_latest_csv():
-    csv_file = order_engine.get_latest_csv()
-    return Response(
-        csv_file,
-        mimetype="text/csv",
-        headers={"Content-disposition":
-                 "attachment; filename=latest_bonus_payments.csv"})
+    upload_id = request.args.get('upload_id')
+    result = order_engine.get_payment_result(upload_id)
+    if result is None:
+        if upload_id is not None:
+            return create_error_response('Upload {} not found'.format(upload_id), 404)
+        return Response(
+            order_engine.render_export([], 'csv'),
+            mimetype="text/csv",
+            headers={"Content-disposition":
+                     "attachment; filename=latest_bonus_payments.csv"})
+    return send_file(order_engine.get_export_file(result, 'csv'), mimetype="text/csv", as_attachment=True,
+                     attachment_filename='latest_bonus_payments.csv', conditional=True)
+
+
+# exports bonus payments of an upload (latest if upload_id is not given) as csv or ndjson.
+# full exports are served from precomputed files and support Range requests. filtering by
+# referrer (id or email), order or rule and pagination with page/per_page render on the fly.
+# responses are gzipped when the client accepts it
+@app.route("/export")
+def export_payments():
+    upload_id = request.args.get('upload_id')
+    export_format = request.args.get('format', 'csv')
+    if export_format not in export_formats:
+        return create_error_response('Unknown export format {}'.format(export_format), 400)
+    result = order_engine.get_payment_result(upload_id)
+    if result is None:
+        return create_error_response('Upload {} not found'.format(upload_id), 404)
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', type=int)
+    if page < 1 or (per_page is not None and per_page < 1):
+        return create_error_response('page and per_page must be positive', 400)
+    referrer = request.args.get('referrer')
+    order = request.args.get('order')
+    rule = request.args.get('rule')
+    use_gzip = request.accept_encodings['gzip'] > 0
+    filename = 'bonus_payments_{}.{}'.format(result['upload_id'], export_format)
+
+    if per_page is None and referrer is None and order is None and rule is None:
+        response = send_file(order_engine.get_export_file(result, export_format, use_gzip),
+                             mimetype=export_formats[export_format], as_attachment=True,
+                             attachment_filename=filename, conditional=True)
+    else:
+        payments = order_engine.filter_payments(order_engine.get_payments(result), referrer, order, rule)
+        total_count = len(payments)
+        if per_page is not None:
+            payments = payments[(page - 1) * per_page: page * per_page]
+        body = order_engine.render_export(payments, export_format).encode('utf-8')
+        if use_gzip:
+            body = gzip.compress(body)
+        response = Response(
+            body,
+            mimetype=export_formats[export_format],
+            headers={"Content-disposition": "attachment; filename={}".format(filename)})
+        response.headers['X-Total-Count'] = total_count
+        if per_page is not None:
+            response.headers['X-Page'] = page
+            response.headers['X-Per-Page'] = per_page
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
 
 
 @app.errorhandler(404)
@@ -148,5 +241,6 @@ def method_not_allowed(error):
     return "405 METHOD NOT ALLOWED", 405
 
 
+# For production run several workers instead, e.g. gunicorn --workers 4 --bind 127.0.0.1:5060 index:app
 if __name__ == "__main__":
     app.run(port=5060)
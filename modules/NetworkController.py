@@ -1,5 +1,8 @@
 import time
 import datetime
+import random
+import threading
+import os
 from timeit import default_timer as timer
 
 '''
@@ -17,49 +20,180 @@ user object:
 '''
 
 
+# true if a worker process with this pid is still running on this host
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
 class NetworkController:
-    def __init__(self, db_controller, selenium_controller, process_interval_seconds, manual_process=False):
+    def __init__(self, db_controller, selenium_controller, process_interval_seconds, manual_process=False,
+                 process_jitter_seconds=0, listing_page_size=500):
 
         # getting running Selenium and TinyDB controller instances
         self.selenium = selenium_controller
         self.db = db_controller
 
         self.process_interval = process_interval_seconds
+        self.process_jitter = process_jitter_seconds  # scheduled runs start up to this many seconds early or late
+        self.scheduled = not manual_process  # manual mode only runs on trigger_process()
+        self.listing_page_size = listing_page_size  # affiliates fetched per datatables page
+        self.listing_records_total = None  # recordsTotal reported by the last listing fetch
+        self.network_index = None  # lookup tables over the shared user table, see get_network_index()
         self.running = True
+        self.next_run_time = None  # unix time of the next scheduled cycle
+        self.trigger_event = threading.Event()  # set by trigger_process(), merges triggers into one pending cycle
+        self.manual_pending = False  # a triggered cycle was skipped because another worker was syncing
+        self.trigger_retry_interval = 10  # seconds between attempts to run a pending cycle
         self.debug = True
         self.log = True
         self.debug_print("Network Controller initialized!")
 
-        if not manual_process:
-            # main process lifecycle
-            while self.running:
-                self.process()
+        # main process lifecycle runs in the background so the caller is never blocked
+        self.scheduler_thread = threading.Thread(target=self.scheduler_loop, daemon=True)
+        self.scheduler_thread.start()
+
+    def scheduler_loop(self):
+        last_start = time.time()
+        self.next_run_time = self.get_next_run_time(last_start)
+        while self.running:
+            delay = None
+            if self.scheduled:
+                delay = max(self.next_run_time - time.time(), 0)
+            if self.manual_pending:
+                # another worker holds the sync, check again in a while
+                delay = self.trigger_retry_interval if delay is None else min(delay, self.trigger_retry_interval)
+            self.publish_state()
+            # a skipped manual cycle stays pending until another worker's cycle has finished.
+            # marked pending before the trigger is cleared so it is never reported as idle
+            if self.trigger_event.wait(delay):
+                self.manual_pending = True
+            # triggers arriving from here on wait for the next cycle
+            self.trigger_event.clear()
+            if not self.running:
+                break
+            # taken before the cycle runs, so cycles start every interval regardless of their duration
+            cycle_start = time.time()
+            if self.manual_pending:
+                if self.process('manual'):
+                    self.manual_pending = False
+                    last_start = cycle_start
+            elif self.ran_recently():
+                self.debug_print("Network was synced recently by another worker. Process cycle skipped.")
+                last_start = cycle_start
+            else:
+                self.process('schedule')
+                last_start = cycle_start
+            self.next_run_time = self.get_next_run_time(last_start)
+
+        # terminate lifecycle
+        self.debug_print("Network Controller process terminated.")
+
+    # unix time of the next scheduled cycle, None in manual mode
+    def get_next_run_time(self, last_start):
+        if not self.scheduled:
+            return None
+        return last_start + self.process_interval + random.uniform(-self.process_jitter, self.process_jitter)
+
+    # true if any worker started a cycle within the last half interval
+    def ran_recently(self):
+        last_run = self.get_last_run()
+        if last_run is None:
+            return False
+        return time.time() - last_run['started_at'] < self.process_interval / 2
+
+    # runs one sync cycle and records its statistics. skipped if a cycle
+    # is still running in this or another worker. returns False if skipped
+    def process(self, trigger='manual'):
+        # waits briefly, status checks may hold the lock for an instant
+        with self.db.try_lock('network_sync', 1) as acquired:
+            if not acquired:
+                self.debug_print("Previous process cycle still running! Process cycle skipped.")
+                return False
+            start_time = timer()
+            self.debug_print("Starting process cycle")
+            run_stats = {'trigger': trigger, 'started_at': time.time(), 'status': 'success', 'user_count': 0}
+            try:
+                # Process cycle start ===========================
+
+                run_stats['user_count'] = self.sync_network()
 
-            # terminate lifecycle
-            self.debug_print("Network Controller process terminated.")
+                # Process cycle end =============================
+            except Exception as e:
+                run_stats['status'] = 'failed: {}'.format(e)
+                self.debug_print("Process cycle failed: {}".format(e))
+            run_stats['duration_seconds'] = timer() - start_time
+            self.db.insert('network_runs', run_stats)
+            self.debug_print("Process cycle took {:7.2f} seconds.".format(run_stats['duration_seconds']))
+            return True
+
+    # logs in with a fresh browser and rebuilds the network. returns the number of users fetched
+    def sync_network(self):
+        self.selenium.start_browser()
+        try:
+            self.selenium.secomapp_login()
+            return self.build_network()
+        finally:
             self.selenium.close_browser()
 
-    def process(self):
-        start_time = timer()
-        self.debug_print("Starting process cycle")
-        if self.selenium.browser_is_running():  # if selenium browser is running
-            # Process cycle start ===========================
+    # queues a cycle to run as soon as possible. triggers made while a cycle
+    # is pending or running are merged into a single follow-up cycle
+    def trigger_process(self):
+        self.trigger_event.set()
+        self.publish_state()
+        return self.get_schedule_state()
 
-            self.build_network()  # build network from scratch
+    # shares this worker's schedule through the network_schedule table
+    def publish_state(self):
+        self.db.upsert('network_schedule', 'pid', os.getpid(), {
+            'pid': os.getpid(),
+            'next_run_time': self.next_run_time,
+            'pending': self.manual_pending or self.trigger_event.is_set()
+        })
 
-            # Process cycle end =============================
+    def get_last_run(self):
+        last_runs = self.db.get_latest('network_runs', 1)
+        if len(last_runs) > 0:
+            return last_runs[0]
         else:
-            self.debug_print("Selenium browser is not running! Process cycle skipped.")
-        end_time = timer()
-        duration = end_time - start_time
-        delay = self.process_interval - duration
-        self.debug_print("Process cycle took {:7.2f} seconds. "
-                         "Starting next process cycle in {:7.2f} seconds".format(duration, delay))
-        time.sleep(delay)
+            return None
+
+    # schedule across all live workers and the last cycle run by any of them.
+    # rows left behind by workers that exited are removed along the way
+    def get_schedule_state(self):
+        workers = []
+        for worker in self.db.get_all('network_schedule'):
+            if process_alive(worker['pid']):
+                workers.append(worker)
+            else:
+                self.db.remove('network_schedule', 'pid', worker['pid'])
+        next_run_times = [worker['next_run_time'] for worker in workers if worker['next_run_time'] is not None]
+        next_run_at = None
+        if len(next_run_times) > 0:
+            next_run_at = str(datetime.datetime.fromtimestamp(min(next_run_times)))
+        last_run = self.get_last_run()
+        if last_run is not None:
+            last_run = dict(last_run)
+            last_run['started_at'] = str(datetime.datetime.fromtimestamp(last_run['started_at']))
+        return {
+            'scheduled': self.scheduled,
+            'interval_seconds': self.process_interval,
+            'jitter_seconds': self.process_jitter,
+            'next_run_at': next_run_at,
+            'running': self.db.is_locked('network_sync'),
+            'pending': any(worker['pending'] for worker in workers),
+            'last_run': last_run,
+        }
 
     def quit_process(self):
         self.debug_print("quitting process after current running iteration..")
         self.running = False
+        self.trigger_event.set()  # wake the scheduler so it can exit
 
     def debug_print(self, string):
         prefix = "[NetworkCtrl] {} - ".format(datetime.datetime.now())
@@ -73,11 +207,11 @@ class NetworkController:
     # builds user network from scratch. requires login
     def build_network(self):
         self.debug_print("Building network..")
-        self.db.tables['user'].purge_tables()  # clears all entries in table
-        all_users = self.fetch_all_users()
-        for user in all_users:
+        network = []
+        # listing pages are fetched lazily, so detail fetches start with the first page
+        for user in self.iter_all_users():
             user_info = self.fetch_user_info(user['id'])
-            self.db.insert('user', {
+            network.append({
                 'id': user['id'],
                 'first_name': user['first_name'],
                 'last_name': user['last_name'],
@@ -85,21 +219,22 @@ class NetworkController:
                 'parent_id': user_info['parent_id'],
                 'children': [],
             })
+        # a partial listing must not replace the live network
+        if self.listing_records_total is not None and len(network) < self.listing_records_total:
+            raise RuntimeError('Fetched only {} of {} users, network not updated'.format(
+                len(network), self.listing_records_total))
         self.debug_print("Users fetched, connecting parent and child nodes")
-        for user in all_users:
-            user_id = user['id']
-            # get current user's parent id from local db
-            user_db_obj = self.db.search('user', 'id', user_id)[0]
-            parent_id = user_db_obj['parent_id']
-            # if this user has a parent
-            if parent_id > 0:
-                # append this user's id to its parent's children list
-                parent_object = self.db.search('user', 'parent_id', parent_id)[0]
-                children_list = parent_object['children']
-                children_list.append(user['id'])
-                self.db.update('user', 'id', parent_id, 'children', children_list)
-                self.debug_print('Linked  {} --> {}'.format(user_id, parent_id))
+        users_by_id = {str(user['id']): user for user in network}
+        for user in network:
+            parent_id = user['parent_id']
+            # if this user has a parent, append this user's id to its parent's children list
+            if parent_id > 0 and str(parent_id) in users_by_id:
+                users_by_id[str(parent_id)]['children'].append(user['id'])
+                self.debug_print('Linked  {} --> {}'.format(user['id'], parent_id))
+        # publish the new network as a single snapshot for every worker
+        self.db.replace_all('user', network)
         self.debug_print("Build network complete!")
+        return len(network)
 
     # fetches from secomapp the user's details. requires login.
     def fetch_user_info(self, user_id):
@@ -108,35 +243,78 @@ class NetworkController:
 
     # fetches from secomapp a list of all users. requires login.
     def fetch_all_users(self):
-        payload = self.selenium.fetch_json('https://af.secomapp.com/admin/affiliates/datatables')
-        return payload['data']
+        return list(self.iter_all_users())
+
+    # yields all users from secomapp, one datatables page at a time so only a single
+    # page of the listing is held in memory. requires login.
+    def iter_all_users(self):
+        self.listing_records_total = None
+        seen_ids = set()
+        start = 0
+        draw = 1
+        while True:
+            payload = self.selenium.fetch_json(
+                'https://af.secomapp.com/admin/affiliates/datatables?draw={}&start={}&length={}'.format(
+                    draw, start, self.listing_page_size))
+            page = payload['data']
+            for user in page:
+                # the listing may shift between pages while affiliates sign up
+                if user['id'] not in seen_ids:
+                    seen_ids.add(user['id'])
+                    yield user
+            start += len(page)
+            draw += 1
+            self.listing_records_total = payload.get('recordsTotal')
+            if len(page) == 0:
+                break
+            if self.listing_records_total is not None:
+                # the server may cap length below listing_page_size, so only the total ends the listing
+                if start >= self.listing_records_total:
+                    break
+            # without a total, a short page is the last one and a longer one means
+            # the server ignored the paging parameters
+            elif len(page) != self.listing_page_size:
+                break
+
+    # returns lookup tables over the current network snapshot. the snapshot is
+    # reloaded only when the user table changes on disk, so all workers serve
+    # the same network without scanning the table for every lookup
+    def get_network_index(self):
+        version = self.db.get_version('user')
+        network_index = self.network_index
+        if network_index is None or network_index['version'] != version:
+            by_id = {}
+            by_email = {}
+            for user in self.db.get_all('user'):
+                # keep the first match, like search()[0]
+                by_id.setdefault(user['id'], user)
+                by_email.setdefault(user['email'], user)
+            network_index = {'version': version, 'by_id': by_id, 'by_email': by_email}
+            self.network_index = network_index
+        return network_index
 
     # given an id, get its parent_id from local db
     def get_parent(self, user_id):
-        user_object = self.db.search('user', 'id', user_id)[0]
+        user_object = self.get_network_index()['by_id'][user_id]
         return user_object['parent_id']
 
     # given an email address, get its user object
     def get_user_by_email(self, email):
-        user_object = self.db.search('user', 'email', email)[0]
+        user_object = self.get_network_index()['by_email'][email]
         return user_object
 
     # given email address, get user id. returns 0 if none found
     def get_user_id_by_email(self, email):
-        search_list = self.db.search('user', 'email', email)
-        if len(search_list) > 0:
-            user_object = search_list[0]
+        user_object = self.get_network_index()['by_email'].get(email)
+        if user_object is not None:
             return user_object['id']
         else:
             return 0
 
     # given id, get email.
     def get_email_by_id(self, user_id):
-        print(user_id)
-        print(type(user_id))
-        search_list = self.db.search('user', 'id', user_id)
-        if len(search_list) > 0:
-            user_object = search_list[0]
+        user_object = self.get_network_index()['by_id'].get(user_id)
+        if user_object is not None:
             return user_object['email']
         else:
             return ''
@@ -145,13 +323,13 @@ class NetworkController:
     # a particular product purchased by its children
     def get_bonus_payments(self, user_id, product_amount, bonus_list):
         # example bonus list (8%, 2%, 2%) = [0.08, 0.02, 0.02]
+        users_by_id = self.get_network_index()['by_id']
         current_id = user_id
         payments = []
         for i in range(len(bonus_list)):
-            user_query_list = self.db.search('user', 'id', current_id)
+            current_user_obj = users_by_id.get(current_id)
             # this user is in the db (registered under secomapp)
-            if len(user_query_list) > 0:
-                current_user_obj = user_query_list[0]
+            if current_user_obj is not None:
                 # this user has a parent
                 if current_user_obj['parent_id'] > 0:
                     current_id = current_user_obj['parent_id']  # select the parent
@@ -1,16 +1,28 @@
 import datetime
 import csv
+import gzip
+import io
+import json
+import os
+import time
+import uuid
 
 csv_columns = 'order_name,customer_email,purchased_item,purchased_item_price,purchased_item_quantity,' \
               'purchased_item_subtotal,referrer_id,referrer_email,commission_product_rule,commission_percentage,' \
               'referrer_commission_amount'
+csv_column_names = csv_columns.split(',')
+
+# supported export formats and their mimetypes
+export_formats = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
 
 class OrderController:
-    def __init__(self, db_engine, mlm_network, referral_bonus_rules):
+    def __init__(self, db_engine, mlm_network, referral_bonus_rules, result_cache_max_bytes=50 * 1024 * 1024,
+                 export_path='./exports'):
         self.db_engine = db_engine
         self.mlm_network = mlm_network
         self.referral_bonus_rules = referral_bonus_rules
-        self.payment_list = []
+        self.result_cache_max_bytes = result_cache_max_bytes
+        self.export_path = export_path
         self.debug = True
         self.log = True
 
@@ -23,8 +35,21 @@ class OrderController:
         })
         if self.debug: print(prefix + string)
 
-    def read_csv(self, filepath):
-        self.payment_list = []
+    # processes an orders csv export and stores the resulting bonus payments under upload_id
+    # (the file's content hash) in the payment_results table, readable from any worker.
+    # orders already processed by an earlier upload are not computed again, their stored
+    # payments are reused so the result still covers every order in the file
+    def read_csv(self, filepath, upload_id):
+        # identical file uploaded before, serve the cached result
+        if self.get_payment_result(upload_id) is not None:
+            self.db_engine.update('payment_results', 'upload_id', upload_id, 'uploaded_at', time.time())
+            self.debug_print('Upload {} already processed, serving cached result'.format(upload_id))
+            return upload_id
+
+        processed_orders = self.get_processed_orders()
+        order_ids = []  # every order in the file, in file order
+        seen_orders = set()
+        new_orders = []  # (email, order_id, item_list) of orders not processed yet
 
         with open(filepath, 'r') as csv_file:
             csv_reader = csv.DictReader(csv_file)
@@ -37,61 +62,218 @@ class OrderController:
                 current_email = line['Email']
                 # its a new order!
                 if current_order != previous_order:
-                    # process previous order
+                    # queue previous order
                     if len(item_list) > 0:
-                        self.process_order(previous_email, previous_order, item_list)
+                        new_orders.append((previous_email, previous_order, item_list))
                     item_list = []
+                    if current_order not in seen_orders:
+                        seen_orders.add(current_order)
+                        order_ids.append(current_order)
+                previous_order = current_order
+                previous_email = current_email
+                # orders from an earlier upload are skipped without parsing their line items
+                if current_order in processed_orders:
+                    continue
                 item_list.append({
                     'name': line['Lineitem name'],
                     'quantity': line['Lineitem quantity'],
                     'price': line['Lineitem price']
                 })
-                previous_order = current_order
-                previous_email = current_email
-            self.process_order(previous_email, previous_order, item_list)
-        self.debug_print('Processed {} payable bonus payments'.format(len(self.payment_list)))
-
-    def process_order(self, email, order_id, item_list):
-        # if this order does not exist in the history already
-        if not self.db_engine.exists('order_history', 'order_id', order_id):
-            self.db_engine.insert('order_history', {'order_id': order_id})
-            user_id = self.mlm_network.get_user_id_by_email(email)
-            # if email exists in secomapp
-            if user_id != 0:
-                # for each item
-                for item in item_list:
-                    rule_applied = False
-                    for rule in self.referral_bonus_rules:
-                        if rule['product_name'] == item['name']:  # product rule match!
-                            item_subtotal = int(item['quantity']) * float(item['price'])
-                            bonus_payments = self.mlm_network.get_bonus_payments(user_id, item_subtotal, rule['bonus_tiers'])
-                            self.process_bonus_payments(
-                                order_id, email, bonus_payments, item['name'], item['price'],
-                                item['quantity'], item_subtotal, rule['product_name']
-                            )
-                            rule_applied = True
-                            break
-                    if not rule_applied:
+            if len(item_list) > 0:
+                new_orders.append((previous_email, previous_order, item_list))
+
+        new_history = []
+        for email, order_id, order_items in new_orders:
+            order_payments = []
+            self.process_order(email, order_id, order_items, order_payments)
+            # line items are kept so commission rules can be replayed, see SimulationController
+            new_history.append({'order_id': order_id, 'email': email, 'items': order_items, 'payments': order_payments})
+
+        # recorded in one locked write so two workers never both pay out the same order.
+        # orders another worker recorded in the meantime keep that worker's payments
+        inserted = self.db_engine.insert_missing('order_history', 'order_id', new_history)
+        if len(inserted) < len(new_history):
+            processed_orders = self.get_processed_orders()
+        for entry in inserted:
+            processed_orders[entry['order_id']] = entry['payments']
+
+        payment_list = []
+        for order_id in order_ids:
+            payment_list.extend(processed_orders.get(order_id, []))
+
+        # the payment rows live in the upload's export files, written before the result is visible
+        # so downloads never wait on rendering. the table only keeps metadata
+        self.write_exports(upload_id, payment_list)
+        # upserted so a file processed by two workers at once, or re-processed after its
+        # exports disappeared, never leaves two rows pointing at the same export files
+        self.db_engine.upsert('payment_results', 'upload_id', upload_id, {
+            'upload_id': upload_id,
+            'filename': os.path.basename(filepath),
+            'timestamp': str(datetime.datetime.now()),
+            'uploaded_at': time.time(),
+            'size': self.get_exports_size(upload_id)
+        })
+        self.debug_print('Processed {} payable bonus payments ({} new orders, {} orders reused)'.format(
+            len(payment_list), len(inserted), len(order_ids) - len(inserted)))
+        self.evict_results()
+        return upload_id
+
+    # returns a dict of order_id -> bonus payment rows for every order in the history.
+    # entries recorded before payments were stored have an empty list
+    def get_processed_orders(self):
+        processed_orders = {}
+        for entry in self.db_engine.get_all('order_history'):
+            processed_orders[entry['order_id']] = entry.get('payments', [])
+        return processed_orders
+
+    # drops least recently used results once the cache outgrows result_cache_max_bytes.
+    # the order history is kept, so an evicted upload is rebuilt from it without recomputing
+    def evict_results(self):
+        evicted = self.db_engine.trim('payment_results', 'size', self.result_cache_max_bytes,
+                                      lambda result: self.get_last_used(result['upload_id']))
+        for result in evicted:
+            self.remove_exports(result['upload_id'])
+            self.debug_print('Evicted cached result of upload {}'.format(result['upload_id']))
+
+    # computes the bonus payments of one order and appends them to payment_list
+    def process_order(self, email, order_id, item_list, payment_list):
+        user_id = self.mlm_network.get_user_id_by_email(email)
+        # if email exists in secomapp
+        if user_id != 0:
+            # for each item
+            for item in item_list:
+                rule_applied = False
+                for rule in self.referral_bonus_rules:
+                    if rule['product_name'] == item['name']:  # product rule match!
                         item_subtotal = int(item['quantity']) * float(item['price'])
-                        bonus_payments = self.mlm_network.get_bonus_payments(user_id, item_subtotal, self.referral_bonus_rules[0]['bonus_tiers'])
+                        bonus_payments = self.mlm_network.get_bonus_payments(user_id, item_subtotal, rule['bonus_tiers'])
                         self.process_bonus_payments(
                             order_id, email, bonus_payments, item['name'], item['price'],
-                            item['quantity'], item_subtotal, self.referral_bonus_rules[0]['product_name']
+                            item['quantity'], item_subtotal, rule['product_name'], payment_list
                         )
+                        rule_applied = True
+                        break
+                if not rule_applied:
+                    item_subtotal = int(item['quantity']) * float(item['price'])
+                    bonus_payments = self.mlm_network.get_bonus_payments(user_id, item_subtotal, self.referral_bonus_rules[0]['bonus_tiers'])
+                    self.process_bonus_payments(
+                        order_id, email, bonus_payments, item['name'], item['price'],
+                        item['quantity'], item_subtotal, self.referral_bonus_rules[0]['product_name'], payment_list
+                    )
 
     def process_bonus_payments(self, order_id, customer_email, bonus_payments, purchased_item,
                                purchased_item_price, purchased_item_quantity, purchased_item_subtotal,
-                               commission_product_rule):
+                               commission_product_rule, payment_list):
+        # one row per payment, values in csv_columns order
         for payment in bonus_payments:
-            bonus_payment_string = '{},{},{},{},{},{},{},{},{},{},{}'.format(
+            payment_list.append([
                 order_id, customer_email, purchased_item, purchased_item_price, purchased_item_quantity,
                 purchased_item_subtotal, payment['id'], self.mlm_network.get_email_by_id(payment['id']),
                 commission_product_rule, payment['commission_percentage'], payment['payment']
-            )
-            self.payment_list.append(bonus_payment_string)
-
-    def get_latest_csv(self):
-        csv_file = csv_columns + '\n'
-        for payment_string in self.payment_list:
-            csv_file += payment_string + '\n'
-        return csv_file
+            ])
+
+    # returns the stored result metadata of an upload, or of the latest upload if no id is given,
+    # and marks it as used for eviction. None if not found.
+    # recency is the mtime of the ndjson export, so reads never rewrite the table
+    def get_payment_result(self, upload_id=None):
+        if upload_id is None:
+            results = self.db_engine.get_all('payment_results')
+            if len(results) > 0:
+                results = [max(results, key=lambda result: result.get('uploaded_at', 0))]
+        else:
+            results = self.db_engine.search('payment_results', 'upload_id', upload_id)
+        # results without their rows on disk were evicted by another worker
+        if len(results) == 0 or not os.path.exists(self.get_export_path(results[0]['upload_id'], 'ndjson')):
+            return None
+        try:
+            os.utime(self.get_export_path(results[0]['upload_id'], 'ndjson'))
+        except FileNotFoundError:
+            return None
+        return results[0]
+
+    # unix time an upload's result was last used, 0 if its exports are gone
+    def get_last_used(self, upload_id):
+        try:
+            return os.path.getmtime(self.get_export_path(upload_id, 'ndjson'))
+        except FileNotFoundError:
+            return 0
+
+    # reads the payment rows of a result back from its ndjson export
+    def get_payments(self, result):
+        payments = []
+        with open(self.get_export_path(result['upload_id'], 'ndjson'), 'r') as export_file:
+            for line in export_file:
+                payment = json.loads(line)
+                payments.append([payment[column] for column in csv_column_names])
+        return payments
+
+    # returns the payment rows matching every given filter. referrer matches either id or email
+    def filter_payments(self, payments, referrer=None, order=None, rule=None):
+        filtered = []
+        for row in payments:
+            if referrer is not None and str(row[6]) != referrer and row[7] != referrer:
+                continue
+            if order is not None and row[0] != order:
+                continue
+            if rule is not None and row[8] != rule:
+                continue
+            filtered.append(row)
+        return filtered
+
+    # renders payment rows in one of export_formats
+    def render_export(self, payments, export_format):
+        if export_format == 'ndjson':
+            return ''.join(json.dumps(dict(zip(csv_column_names, row))) + '\n' for row in payments)
+        output = io.StringIO()
+        writer = csv.writer(output, lineterminator='\n')
+        writer.writerow(csv_column_names)
+        writer.writerows(payments)
+        return output.getvalue()
+
+    def get_export_path(self, upload_id, export_format, compressed=False):
+        filename = '{}.{}'.format(upload_id, export_format)
+        if compressed:
+            filename += '.gz'
+        return os.path.join(self.export_path, filename)
+
+    # precomputes every export format of a result, plain and gzipped, so downloads are served straight from disk.
+    # existing files are kept unless overwrite is set
+    def write_exports(self, upload_id, payments, overwrite=True):
+        os.makedirs(self.export_path, exist_ok=True)
+        for export_format in export_formats:
+            path = self.get_export_path(upload_id, export_format)
+            if not overwrite and os.path.exists(path) and os.path.exists(path + '.gz'):
+                continue
+            content = self.render_export(payments, export_format).encode('utf-8')
+            self.write_file(path, content)
+            self.write_file(path + '.gz', gzip.compress(content))
+
+    # writes to a temporary name first so other workers never serve a half-written file
+    def write_file(self, path, content):
+        temp_path = '{}.{}.part'.format(path, uuid.uuid4().hex)
+        with open(temp_path, 'wb') as output_file:
+            output_file.write(content)
+        os.replace(temp_path, path)
+
+    # bytes on disk taken by all export files of an upload
+    def get_exports_size(self, upload_id):
+        size = 0
+        for export_format in export_formats:
+            for compressed in [False, True]:
+                size += os.path.getsize(self.get_export_path(upload_id, export_format, compressed))
+        return size
+
+    def remove_exports(self, upload_id):
+        for export_format in export_formats:
+            for compressed in [False, True]:
+                try:
+                    os.remove(self.get_export_path(upload_id, export_format, compressed))
+                except FileNotFoundError:
+                    pass
+
+    # returns the path of a result's precomputed export, writing it first if it is missing
+    def get_export_file(self, result, export_format, compressed=False):
+        path = self.get_export_path(result['upload_id'], export_format, compressed)
+        if not os.path.exists(path):
+            self.write_exports(result['upload_id'], self.get_payments(result), False)
+        return path
@@ -0,0 +1,150 @@
+import datetime
+import numpy as np
+
+'''
+Replays the stored order history against candidate referral bonus rule sets.
+Read only: nothing is written to order_history, payment_results or the user table.
+
+rule set: same structure as referral_bonus_rules in index.py, the first rule is the default
+[
+    {'product_name': String, 'bonus_tiers': Number[]},
+    ...
+]
+'''
+
+# referral chains are walked this many levels up at most, bounds the work of a single request
+max_bonus_tiers = 20
+
+
+class SimulationController:
+    def __init__(self, db_engine, mlm_network):
+        self.db_engine = db_engine
+        self.mlm_network = mlm_network
+        self.debug = True
+        self.log = True
+
+    def debug_print(self, string):
+        prefix = "[Simulation] "
+        if self.log: self.db_engine.insert('logs', {
+            'timestamp': str(datetime.datetime.now()),
+            'source': 'Simulation',
+            'text': string
+        })
+        if self.debug: print(prefix + string)
+
+    # raises ValueError if a rule set is not shaped like referral_bonus_rules
+    def validate_rule_sets(self, rule_sets):
+        if not isinstance(rule_sets, list) or len(rule_sets) == 0:
+            raise ValueError('rule_sets must be a non-empty list')
+        for rules in rule_sets:
+            if not isinstance(rules, list) or len(rules) == 0:
+                raise ValueError('each rule set must be a non-empty list of rules')
+            for rule in rules:
+                if not isinstance(rule, dict) or not isinstance(rule.get('product_name'), str) or \
+                        not isinstance(rule.get('bonus_tiers'), list) or \
+                        not all(isinstance(tier, (int, float)) for tier in rule['bonus_tiers']):
+                    raise ValueError('each rule needs a product_name and a list of numeric bonus_tiers')
+                if len(rule['bonus_tiers']) > max_bonus_tiers:
+                    raise ValueError('a rule can have at most {} bonus_tiers'.format(max_bonus_tiers))
+
+    # returns the referrer ids paid at each tier for a purchase by user_id,
+    # walking up the current network like NetworkController.get_bonus_payments()
+    def get_referrer_chain(self, user_id, max_tiers, users_by_id):
+        chain = []
+        current_id = user_id
+        for i in range(max_tiers):
+            current_user_obj = users_by_id.get(current_id)
+            if current_user_obj is None or current_user_obj['parent_id'] <= 0:
+                break
+            current_id = current_user_obj['parent_id']
+            chain.append(current_id)
+        return chain
+
+    # evaluates every rule set against the stored order history and current network in one batch.
+    # every (product, tier, referrer, amount) purchase entry is collected once, independent of the rules,
+    # then weighted by all rule sets at once and summed per referrer and per tier. returns a dict with one result
+    # per rule set, in input order: total payout, payout per tier and payout per referrer
+    def simulate(self, rule_sets):
+        self.validate_rule_sets(rule_sets)
+        max_tiers = max(len(rule['bonus_tiers']) for rules in rule_sets for rule in rules)
+        network_index = self.mlm_network.get_network_index()
+        users_by_id = network_index['by_id']
+        users_by_email = network_index['by_email']
+
+        product_index = {}  # product name -> row in bonus_tiers
+        referrer_index = {}  # referrer id -> column in per_referrer
+        product_rows = []
+        tier_columns = []
+        referrer_columns = []
+        amounts = []
+        simulated_orders = 0
+        skipped_orders = 0
+        invalid_items = 0
+        for entry in self.db_engine.get_all('order_history'):
+            # orders recorded before line items were stored cannot be replayed
+            if 'items' not in entry:
+                skipped_orders += 1
+                continue
+            simulated_orders += 1
+            user_object = users_by_email.get(entry['email'])
+            if user_object is None:
+                continue
+            chain = self.get_referrer_chain(user_object['id'], max_tiers, users_by_id)
+            for item in entry['items']:
+                # a malformed quantity or price in the stored history is skipped, not fatal
+                try:
+                    item_subtotal = int(item['quantity']) * float(item['price'])
+                except (KeyError, TypeError, ValueError):
+                    invalid_items += 1
+                    continue
+                product_row = product_index.setdefault(item['name'], len(product_index))
+                for tier, referrer_id in enumerate(chain):
+                    product_rows.append(product_row)
+                    tier_columns.append(tier)
+                    referrer_columns.append(referrer_index.setdefault(referrer_id, len(referrer_index)))
+                    amounts.append(item_subtotal)
+
+        # bonus_tiers[rule set, product, tier], products without a matching rule use the default rule
+        bonus_tiers = np.zeros((len(rule_sets), len(product_index), max_tiers))
+        for r, rules in enumerate(rule_sets):
+            for product_name, product_row in product_index.items():
+                rule = next((rule for rule in rules if rule['product_name'] == product_name), rules[0])
+                bonus_tiers[r, product_row, :len(rule['bonus_tiers'])] = rule['bonus_tiers']
+
+        # payouts[rule set, entry] = bonus paid for one purchase entry, memory grows with the entries
+        # instead of products * tiers * referrers
+        product_rows = np.array(product_rows, dtype=int)
+        tier_columns = np.array(tier_columns, dtype=int)
+        payouts = bonus_tiers[:, product_rows, tier_columns] * np.array(amounts, dtype=float)
+        rule_set_rows = np.arange(len(rule_sets))[:, np.newaxis]
+        per_referrer = np.zeros((len(rule_sets), len(referrer_index)))
+        np.add.at(per_referrer, (rule_set_rows, np.array(referrer_columns, dtype=int)), payouts)
+        per_tier = np.zeros((len(rule_sets), max_tiers))
+        np.add.at(per_tier, (rule_set_rows, tier_columns), payouts)
+
+        referrer_ids = [None] * len(referrer_index)
+        for referrer_id, column in referrer_index.items():
+            referrer_ids[column] = referrer_id
+        results = []
+        for r in range(len(rule_sets)):
+            referrer_payouts = []
+            for column in np.argsort(-per_referrer[r], kind='stable'):
+                if per_referrer[r, column] <= 0:
+                    break
+                referrer_payouts.append({
+                    'referrer_id': referrer_ids[column],
+                    'referrer_email': self.mlm_network.get_email_by_id(referrer_ids[column]),
+                    'payout': float(per_referrer[r, column])
+                })
+            # only the tiers this rule set defines
+            tier_count = max(len(rule['bonus_tiers']) for rule in rule_sets[r])
+            results.append({
+                'total_payout': float(per_tier[r].sum()),
+                'per_tier': [float(amount) for amount in per_tier[r, :tier_count]],
+                'per_referrer': referrer_payouts
+            })
+        self.debug_print('Simulated {} rule sets over {} orders ({} orders without stored line items skipped, '
+                         '{} invalid line items skipped)'.format(
+                             len(rule_sets), simulated_orders, skipped_orders, invalid_items))
+        return {'simulated_orders': simulated_orders, 'skipped_orders': skipped_orders,
+                'invalid_items': invalid_items, 'results': results}
@@ -1,5 +1,10 @@
 from tinydb import TinyDB, Query
+from contextlib import contextmanager
 import datetime
+import fcntl
+import os
+import threading
+import time
 
 # Guidelines for setting debug level:
 # on global variable setting: 0 = include only important, 1 = include normal, 2 = include all
@@ -12,6 +17,7 @@ class TinyDBController:
         self.debug_level = 1  # global debug variable. higher shows more detail.
         self.log = log
         self.tables = {}
+        self.thread_locks = {}  # table name -> RLock, threads of this worker share one file handle per table
         self.table_path = table_path
         for table in tables:
             self.load_table(table)
@@ -27,27 +33,150 @@ class TinyDBController:
         if self.debug_level >= debug_level:
             if self.debug: print(prefix + string)
 
+    def table_file(self, table_name):
+        return self.table_path + '/' + table_name + '.json'
+
+    def open_table(self, table_name):
+        self.tables[table_name] = TinyDB(self.table_file(table_name))
+
+    # TinyDB writes an empty table into a new or empty file when opening it,
+    # so opening must not race with another worker's locked write
     def load_table(self, table_name):
-        self.tables[table_name] = TinyDB(self.table_path + '/' + table_name + '.json')
+        self.thread_locks[table_name] = threading.RLock()
+        with open(self.table_path + '/' + table_name + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self.open_table(table_name)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # holds an inter-process lock on a table so several workers can share the same json files.
+    # writers take an exclusive lock, readers a shared one so they never see a half-written file.
+    # the thread lock keeps threads of this worker off the table's single file handle at the same time
+    @contextmanager
+    def lock_table(self, table_name, exclusive=False):
+        with self.thread_locks[table_name], open(self.table_path + '/' + table_name + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                if exclusive:
+                    # reopen so new document ids account for inserts made by other workers
+                    self.tables[table_name].close()
+                    self.open_table(table_name)
+                else:
+                    # cached query results may be stale if another worker wrote to the file
+                    self.tables[table_name].clear_cache()
+                yield self.tables[table_name]
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # exclusive lock shared by every thread and worker, for long running jobs.
+    # yields False if it is still held by someone else after timeout seconds
+    @contextmanager
+    def try_lock(self, lock_name, timeout=0):
+        deadline = time.time() + timeout
+        with open(self.table_path + '/' + lock_name + '.lock', 'a') as lock_file:
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.time() >= deadline:
+                        yield False
+                        return
+                    time.sleep(0.05)
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # true if a try_lock() on lock_name is held by any thread or worker
+    def is_locked(self, lock_name):
+        with open(self.table_path + '/' + lock_name + '.lock', 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return False
 
     def insert(self, table_name, obj):
-        self.tables[table_name].insert(obj)
+        with self.lock_table(table_name, True) as table:
+            table.insert(obj)
+
+    # inserts the objs whose query_key value is not in the table yet, in one locked write.
+    # returns the inserted objs
+    def insert_missing(self, table_name, query_key, objs):
+        with self.lock_table(table_name, True) as table:
+            existing = set(entry[query_key] for entry in table.all() if query_key in entry)
+            missing = []
+            for obj in objs:
+                if obj[query_key] not in existing:
+                    existing.add(obj[query_key])
+                    missing.append(obj)
+            table.insert_multiple(missing)
+            return missing
 
     def update(self, table_name, query_key, query_value, update_key, update_value):
         q = Query()
-        self.tables[table_name].update({update_key: update_value}, q[query_key] == query_value)
+        with self.lock_table(table_name, True) as table:
+            table.update({update_key: update_value}, q[query_key] == query_value)
         # self.debug_print('updated {} to {} for {} == {} in table \'{}\''.format(update_key, update_value, query_key, query_value, table_name), 2)
 
+    # replaces the entry matching query_key == query_value with obj, or inserts obj if none matches
+    def upsert(self, table_name, query_key, query_value, obj):
+        q = Query()
+        with self.lock_table(table_name, True) as table:
+            table.upsert(obj, q[query_key] == query_value)
+
+    def remove(self, table_name, query_key, query_value):
+        q = Query()
+        with self.lock_table(table_name, True) as table:
+            table.remove(q[query_key] == query_value)
+
+    # swaps the whole content of a table in one locked write, so readers
+    # in other workers see either the old or the new snapshot, never a partial one
+    def replace_all(self, table_name, objs):
+        with self.lock_table(table_name, True) as table:
+            table.purge()
+            table.insert_multiple(objs)
+
+    # removes the entries with the lowest sort_key(entry) values until the sum of their size_key values
+    # is at most max_size. the entry with the highest sort_key is always kept. returns the removed entries
+    def trim(self, table_name, size_key, max_size, sort_key):
+        with self.lock_table(table_name, True) as table:
+            entries = sorted(table.all(), key=sort_key)
+            total_size = sum(entry.get(size_key, 0) for entry in entries)
+            removed = []
+            while total_size > max_size and len(removed) < len(entries) - 1:
+                entry = entries[len(removed)]
+                total_size -= entry.get(size_key, 0)
+                removed.append(entry)
+            if len(removed) > 0:
+                table.remove(doc_ids=[entry.doc_id for entry in removed])
+            return removed
+
     # returns a list
     def search(self, table_name, query_key, query_value):
         q = Query()
-        return self.tables[table_name].search(q[query_key] == query_value)
+        with self.lock_table(table_name) as table:
+            return table.search(q[query_key] == query_value)
+
+    def get_all(self, table_name):
+        with self.lock_table(table_name) as table:
+            return table.all()
 
     # only gets latest n entries from a table
     def get_latest(self, table_name, n):
-        all_entries = self.tables[table_name].all()
+        all_entries = self.get_all(table_name)
         return all_entries[max(len(all_entries) - n, 0): len(all_entries)]
 
     def exists(self, table_name, query_key, query_value):
         q = Query()
-        return len(self.tables[table_name].search(q[query_key] == query_value)) > 0
+        with self.lock_table(table_name) as table:
+            return table.contains(q[query_key] == query_value)
+
+    # changes whenever the table file is rewritten, by this or any other worker
+    def get_version(self, table_name):
+        with self.lock_table(table_name):
+            stat = os.stat(self.table_file(table_name))
+            return stat.st_mtime_ns, stat.st_size